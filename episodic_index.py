@@ -0,0 +1,137 @@
+import functools
+import logging
+import math
+from story_utils import dumps_json, loads_json
+
+log = logging.getLogger("story")
+EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
+
+@functools.lru_cache(maxsize=1)
+def _embedder():
+    """
+    Load the embedding model once, or return None if it can't be loaded.
+    """
+    try:
+        from fastembed import TextEmbedding
+        return TextEmbedding(model_name=EMBEDDING_MODEL)
+    except Exception as e:
+        log.warning("Episodic index disabled, could not load embedding model: %s", e)
+        return None
+
+def embed(texts):
+    """
+    Embed a list of texts with a local fastembed model.
+    Returns None if fastembed is unavailable so callers can fall back to the full history.
+    """
+    embedder = _embedder()
+    if embedder is None:
+        return None
+    return [vector.tolist() for vector in embedder.embed(texts)]
+
+def _cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class EpisodicIndex:
+    """
+    Stores past (user, assistant) turn pairs with their embeddings so only the
+    most relevant ones need to be sent back to the model.
+    """
+
+    def __init__(self, entries=None):
+        """
+        Initialize with previously stored entries (list of dicts with turn, user, assistant, embedding).
+        """
+        self.entries = list(entries or [])
+
+    def add(self, turn, user_content, assistant_content):
+        """
+        Embed a turn pair and upsert it under `turn`.
+        """
+        vectors = embed([f"{user_content}\n{assistant_content}".strip()])
+        if vectors is None:
+            return
+        self.entries = [entry for entry in self.entries if entry["turn"] != turn]
+        self.entries.append({
+            "turn": turn,
+            "user": user_content,
+            "assistant": assistant_content,
+            "embedding": vectors[0],
+        })
+
+    def discard(self, assistant_content):
+        """
+        Remove the turn pair that produced `assistant_content` (e.g. after an undo).
+        """
+        self.entries = [entry for entry in self.entries if entry["assistant"] != assistant_content]
+
+    def next_turn(self):
+        return max((entry["turn"] for entry in self.entries), default=-1) + 1
+
+    def query(self, text, k=4, exclude=()):
+        """
+        Return up to `k` entries most similar to `text`, in story order.
+        Entries whose assistant content is in `exclude` are skipped.
+        """
+        candidates = [entry for entry in self.entries if entry["assistant"] not in exclude]
+        if not candidates:
+            return []
+        vectors = embed([text])
+        if vectors is None:
+            return []
+        ranked = sorted(candidates, key=lambda entry: _cosine(vectors[0], entry["embedding"]), reverse=True)
+        return sorted(ranked[:k], key=lambda entry: entry["turn"])
+
+    def build_context(self, conversation_history, k=4, recent_turns=2):
+        """
+        Build the messages to send: leading system messages, the retrieved turns,
+        the last `recent_turns` turns verbatim and the new user message.
+        Falls back to the full history while it is still short.
+        """
+        recent_count = 2 * recent_turns + 1
+        if len(conversation_history) <= recent_count + 2 * k + 1:
+            return conversation_history
+
+        leading = []
+        for msg in conversation_history:
+            if msg["role"] != "system":
+                break
+            leading.append(msg)
+        recent = conversation_history[-recent_count:]
+        new_user = recent[-1]["content"] if recent[-1]["role"] == "user" else ""
+        exclude = {msg["content"] for msg in recent if msg["role"] == "assistant"}
+
+        retrieved = []
+        for entry in self.query(new_user, k=k, exclude=exclude):
+            if entry["user"]:
+                retrieved.append({"role": "user", "content": entry["user"]})
+            retrieved.append({"role": "assistant", "content": entry["assistant"]})
+        if not retrieved:
+            return conversation_history
+        return leading + retrieved + recent
+
+    def save(self, filename):
+        """
+        Save the index to a JSON file.
+        """
+        try:
+            with open(filename, "wb") as f:
+                f.write(dumps_json(self.entries, indent=False))
+        except Exception as e:
+            log.error("Error saving story index: %s", e)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load an index from a JSON file, returning an empty index if it is missing.
+        """
+        try:
+            with open(filename, "rb") as f:
+                return cls(loads_json(f.read()))
+        except FileNotFoundError:
+            return cls()
+        except Exception as e:
+            log.error("Error loading story index: %s", e)
+            return cls()
@@ -0,0 +1,63 @@
+import time
+
+TPM_WINDOW = 60.0 # Seconds covered by the per-key token counters
+
+class KeyPool:
+    """
+    Rotates requests across several API clients (one per key) to spread per-key rate limits.
+    """
+
+    def __init__(self, clients):
+        """
+        Initialize with a list of clients, each created with its own API key.
+        """
+        self.clients = list(clients)
+        self.usage = [[] for _ in self.clients] # (timestamp, tokens) per client within the TPM window
+        self.blocked_until = {} # (client index, model) -> monotonic time the rate limit expires
+
+    def __len__(self):
+        return len(self.clients)
+
+    def _tokens_used(self, index, now):
+        self.usage[index] = [(ts, tokens) for ts, tokens in self.usage[index] if now - ts < TPM_WINDOW]
+        return sum(tokens for _, tokens in self.usage[index])
+
+    def acquire(self, model=None):
+        """
+        Return the least-used client that isn't rate limited for `model`, or None if all are.
+        """
+        now = time.monotonic()
+        available = [i for i in range(len(self.clients)) if self.blocked_until.get((i, model), 0.0) <= now]
+        if not available:
+            return None
+        return self.clients[min(available, key=lambda i: self._tokens_used(i, now))]
+
+    def record(self, client, tokens):
+        """
+        Count `tokens` against the client's TPM window.
+        """
+        self.usage[self.clients.index(client)].append((time.monotonic(), tokens))
+
+    def penalize(self, client, retry_after, model=None):
+        """
+        Skip the client for `model` for `retry_after` seconds after it hit a rate limit.
+        """
+        self.blocked_until[(self.clients.index(client), model)] = time.monotonic() + retry_after
+
+    def wait_time(self):
+        """
+        Seconds until the first rate-limited client becomes available again.
+        """
+        now = time.monotonic()
+        return min((until - now for until in self.blocked_until.values() if until > now), default=0.0)
+
+
+def parse_retry_after(error, default=2.0):
+    """
+    Read the retry-after hint (in seconds) from a rate limit error's response headers.
+    """
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after", default))
+    except (AttributeError, TypeError, ValueError):
+        return default
@@ -1,272 +1,221 @@
 import os
 import sys
-from groq import Groq, RateLimitError, APIError # Import necessary Groq classes
-from pick import pick # Add pick import
-from colorama import init, Fore, Style # Import colorama
-from openai import OpenAI
+import argparse
 import glob
+import time
+import logging
 from story_utils import save_story, load_story
 from undo_redo import ConversationHistoryManager
+from episodic_index import EpisodicIndex
+from speculative import SpeculativePrefetcher
+from semantic_cache import SemanticCache
 from dotenv import load_dotenv
 load_dotenv()
-import os
-# Initialize colorama
-init(autoreset=True) # Autoreset ensures color resets after each print
+log = logging.getLogger("story")
 
 # --- Configuration ---
-# Recommended: Load API key from environment variable
-# GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
-# Fallback for simple prototype (less secure):
-GROQ_API_KEY = None # Will prompt user if not set
-OPENAI_API_KEY = None # Not used in this script, but can be set for other purposes
-OPENAI_BASE_URL = "https://openrouter.ai/api/v1" # Not used in this script, but can be set for other purposes
-
-# --- Groq Interaction ---
-def initialize_groq_client():
-    """Initializes and returns the Groq client."""
-    global GROQ_API_KEY
-    if not GROQ_API_KEY:
-        # Try getting from environment variable first
-        GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
-        if not GROQ_API_KEY:
-            GROQ_API_KEY = input(Fore.YELLOW + "Please enter your Groq API Key: " + Style.RESET_ALL) # Yellow prompt
-            if not GROQ_API_KEY:
-                print(Fore.RED + "API Key is required. Exiting.") # Red error
-                sys.exit(1)
-
-    # Note: Adding try...except block here would be ideal for robust error handling with colors
-    client = Groq(api_key=GROQ_API_KEY)
-    # Test connection and fetch models
-    print(Fore.BLUE + "Fetching available models...") # Blue status
-    models_response = client.models.list()
-    # print(models_response) # Keep debug print for now
-    # Filter for models likely suitable for chat/instruction-following and sort them
-    available_models = sorted([
-        model.id for model in models_response.data
-        if "chat" in model.id or "instruct" in model.id or "llama" in model.id or "mixtral" in model.id
-    ])
-    print(available_models) # Keep debug print for now
-    if not available_models:
-            print(Fore.YELLOW + "Warning: No suitable models found or failed to parse model list.") # Yellow warning
-            # Let select_groq_model handle the default if list is empty
-            available_models = []
-
-    print(Fore.BLUE + "Groq client initialized successfully.") # Blue status
-    return client, available_models # Return client and models
-
-def initialize_openai_client():
-    """Initializes and returns the OpenAI client."""
-    global OPENAI_API_KEY, OPENAI_BASE_URL
-    if not OPENAI_API_KEY:
-        # Try getting from environment variable first
-        OPENAI_API_KEY = os.environ.get("OPENROUTER_API_KEY")
-        if not OPENAI_API_KEY:
-            OPENAI_API_KEY = input(Fore.YELLOW + "Please enter your OpenAI API Key: " + Style.RESET_ALL) # Yellow prompt
-            if not OPENAI_API_KEY:
-                print(Fore.RED + "API Key is required. Exiting.") # Red error
-                sys.exit(1)
-
-    # Note: Adding try...except block here would be ideal for robust error handling with colors
-    client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
-    print(Fore.BLUE + "OpenAI client initialized successfully.") # Blue status
-    return client
-
-def select_groq_model(models):
-    """Uses 'pick' to let the user select a model."""
-    if not models:
-        print(Fore.YELLOW + "Could not fetch models or no suitable models found. Using default: llama3-8b-8192") # Yellow warning
-        return "llama3-8b-8192" # Fallback default
-
-    title = Fore.GREEN + "Please choose a Groq model (navigate with arrows, select with Enter):" + Style.RESET_ALL # Green title
-    options = models
-    # Try to find a sensible default like llama3-8b
-    default_index = 0
-    try:
-        # Attempt to find llama3-8b-8192 and set it as default if present
-        default_index = options.index("llama3-8b-8192")
-    except ValueError:
-        pass # Keep default_index 0 if llama3-8b isn't found
-
-    try:
-        selected_model, index = pick(options, title, indicator='=>', default_index=default_index)
-        print(Fore.BLUE + f"Using model: {selected_model}") # Blue status
-        return selected_model
-    except Exception as e: # Catch potential errors during pick usage (e.g., user Ctrl+C)
-        # Using f-string with color codes requires careful concatenation or multiple prints
-        print(Fore.RED + f"\nError during model selection or selection cancelled: {e}. Using default: llama3-8b-8192") # Red error
-        return "llama3-8b-8192" # Fallback default
-
-
-def generate_story_part(client, conversation_history, model="microsoft/wizardlm-2-8x22b:nitro"): #default model for openrouter
-    """Generates the next story part using Groq."""
-    try:
-        completion = client.chat.completions.create(
-            messages=conversation_history,
-            model=model,
-            temperature=0.8, # Adjust creativity
-            max_tokens=512, # Limit response length
-            top_p=1,
-            stop=None, # Can add stop sequences if needed
-            stream=True,
-        )
-
-        response_content = ""
-        for chunk in completion:
-            response_content += chunk.choices[0].delta.content
-            print(Fore.CYAN + chunk.choices[0].delta.content, end='', flush=True)
-
-        # response_content = completion.choices[0].message.content
-        return response_content
-    except RateLimitError:
-        print(Fore.RED + "Rate limit reached. Please wait and try again.") # Red error
-        return None
-    except APIError as e:
-        print(Fore.RED + f"Groq API Error during generation: {e}") # Red error
-        return None
-    except Exception as e:
-        print(Fore.RED + f"An unexpected error occurred during generation: {e}") # Red error
-        return None
-
-
-def generate_story_part_stream(client, conversation_history, model="mistralai/mistral-nemo:nitro"):
-    """Generates the next story part using OPENAI with streaming."""
-    try:
-        completion = client.chat.completions.create(
-            messages=conversation_history,
-            model=model,
-            temperature=0.9, # Adjust creativity
-            max_tokens=256, # Limit response length
-            top_p=1,
-            stop=None, # Can add stop sequences if needed
-            stream=True,
-        )
-        print("\n--- Story Continues ---")
-
-        response_content = ""
-        for chunk in completion:
-            response_content += chunk.choices[0].delta.content
-            print(Fore.CYAN + chunk.choices[0].delta.content, end='', flush=True) # Print in cyan as it streams
-        return response_content
-    except RateLimitError:
-        print(Fore.RED + "Rate limit reached. Please wait and try again.") # Red error
-        return None
-    except APIError as e:
-        print(Fore.RED + f"Groq API Error during generation: {e}") # Red error
-        return None
-    except Exception as e:
-        print(Fore.RED + f"An unexpected error occurred during generation: {e}") # Red error
-        return None
-
-# --- Story Logic ---
-def get_initial_prompt():
-    """Gets initial story parameters from the user."""
-    print("\nLet's start a story!")
-    genre = input("Genre (e.g., fantasy, sci-fi): ")
-    setting = input("Setting (e.g., a dark forest, a spaceship): ")
-    situation = input("Starting situation: ")
-    base_prompt = os.getenv("SYSTEM_PROMPT", "")
-    # Construct a system prompt
-    user_details = f" The story is in the {genre} genre, set in {setting}. The story begins with: {situation}."
-    system_prompt = base_prompt + user_details
-
-    # Return as the first message(s) in the conversation history
-    return [{"role": "system", "content": system_prompt}]
-
+# Set SPECULATIVE_PREFETCH=1 to pre-generate continuations for predicted next actions (uses extra API calls)
+SPECULATIVE_PREFETCH = os.getenv("SPECULATIVE_PREFETCH", "").lower() in ("1", "true", "yes")
+# Continuations stream by default so the first tokens show up right away;
+# set STREAM_CONTINUATIONS=0 to fetch each one as a single response instead
+STREAM_CONTINUATIONS = os.getenv("STREAM_CONTINUATIONS", "1").lower() in ("1", "true", "yes")
 
 # --- Main Application ---
-def run_story_app():
+def save_story_and_index(conversation_history, story_index):
+    """Saves the story and its episodic index next to it. Returns the filename, or None if saving failed."""
+    filename = save_story(conversation_history)
+    if filename:
+        story_index.save(filename + ".index")
+    return filename
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Interactive story generator.")
+    parser.add_argument("--genre", help="Genre of a new story (skips the prompt)")
+    parser.add_argument("--setting", help="Setting of a new story (skips the prompt)")
+    parser.add_argument("--situation", help="Starting situation of a new story (skips the prompt)")
+    parser.add_argument("--profile", help="TOML file with genre, setting and situation keys (default: ~/.terminal-worlds.toml)")
+    return parser.parse_args()
+
+
+def run_story_app(args=None):
+    # Heavy imports (the Groq/OpenAI SDKs, httpx, pick, colorama) are deferred so the banner shows up immediately
+    from pick import pick # Add pick import
+    from story_core import (
+        StoryState, background_executor, complete_story_part,
+        generate_story_part_stream, get_initial_prompt, initialize_openai_client, make_msg,
+        print_cached_response, window_history, ColorFormatter, TITLE, STORY, RESET,
+    )
+    # Status and errors go to stderr so the story on stdout can be piped on its own
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(ColorFormatter("%(message)s"))
+    logging.basicConfig(level=logging.INFO, handlers=[handler])
+
     openai_client = initialize_openai_client()
 
     # Choose to start new or resume
     options = ["Start a new story", "Resume a saved story"]
     choice, _ = pick(options, "Choose an option:", indicator="=>")
+    story_index = EpisodicIndex()
+    # Journal of every change this session, so a crash loses at most the line being written
+    journal_path = time.strftime("story_%Y%m%d_%H%M%S.jsonl")
+    resumed_journal = False
     if choice == "Resume a saved story":
-        saved_files = glob.glob("story_*.json")
+        # .jsonl files are journals left behind by sessions that didn't exit cleanly
+        saved_files = sorted(glob.glob("story_*.json") + glob.glob("story_*.json.zst") + glob.glob("story_*.jsonl"))
         if not saved_files:
-            print("No saved stories found. Starting a new story.")
-            conversation = get_initial_prompt()
+            log.warning("No saved stories found. Starting a new story.")
+            conversation = get_initial_prompt(args)
         else:
             selected_file, _ = pick(saved_files, "Select a saved story to resume:", indicator="=>")
-            conversation = load_story(selected_file)
+            if selected_file.endswith(".jsonl"):
+                try:
+                    conversation = ConversationHistoryManager.replay(selected_file).get_history()
+                    journal_path = selected_file # Keep appending to the recovered journal
+                    resumed_journal = True
+                except (OSError, KeyError, ValueError) as e:
+                    log.error("Error loading story journal: %s", e)
+                    conversation = None
+            else:
+                conversation = load_story(selected_file)
             if not conversation:
-                print("Failed to load story. Starting a new story.")
-                conversation = get_initial_prompt()
+                log.error("Failed to load story. Starting a new story.")
+                conversation = get_initial_prompt(args)
             else:
-                print(f"Resuming story from {selected_file}")
+                log.info("Resuming story from %s", selected_file)
+                story_index = EpisodicIndex.load(selected_file + ".index")
                 initial_assistant_response = conversation[-1]["content"] if conversation and conversation[-1]["role"] == "assistant" else ""
-                print(Fore.GREEN + "\n--- Story Resumed ---")
-                print(Fore.CYAN + initial_assistant_response)
+                print(f"{TITLE}\n--- Story Resumed ---{RESET}")
+                print(f"{STORY}{initial_assistant_response}{RESET}")
     else:
-        conversation = get_initial_prompt()
-
-    # Initialize undo/redo manager
-    history_manager = ConversationHistoryManager(conversation)
+        conversation = get_initial_prompt(args)
+
+    # Keep the system prompt, undo/redo manager and index together for the rest of the session
+    state = StoryState(conversation[0]["content"], ConversationHistoryManager(conversation, log_path=journal_path), story_index)
+    prefetcher = semantic_cache = None
+    if SPECULATIVE_PREFETCH:
+        prefetcher = SpeculativePrefetcher(lambda messages, cancelled: complete_story_part(
+            openai_client, window_history(state.index.build_context(messages), system_tokens=state.system_tokens), cancelled=cancelled,
+        ))
+        # Only prefetched branches can match: a story part the user typed after only comes back through undo
+        semantic_cache = SemanticCache()
+
+    # The journal is kept if the session crashes, so the story can be recovered from the resume picker
+    discard_journal = False
+    try:
+        # Initial story part generation if needed
+        if len(state.history) == 1 and state.history.last_message()["role"] == "system":
+            print(f"{TITLE}\n--- Story Start ---{RESET}")
+            initial_assistant_response = generate_story_part_stream(openai_client, state.messages())
+            if initial_assistant_response:
+                state.history.add_message(make_msg("assistant", initial_assistant_response))
+                state.index.add(state.index.next_turn(), "", initial_assistant_response)
+                print(f"{TITLE}\n-------------------\n{RESET}")
+            else:
+                log.error("Failed to generate initial story part. Exiting.")
+                discard_journal = not resumed_journal # Nothing new to recover, but never delete a recovered journal
+                return
+        else:
+            # Resumed story, skip initial generation
+            pass
 
-    # Initial story part generation if needed
-    if len(history_manager.get_history()) == 1 and history_manager.get_history()[0]["role"] == "system":
-        print(Fore.GREEN + "\n--- Story Start ---")
-        initial_assistant_response = generate_story_part_stream(openai_client, history_manager.get_history())
+        print(f"{TITLE}\n--- Story Start ---{RESET}")
+        initial_assistant_response = generate_story_part_stream(openai_client, window_history(state.messages(), system_tokens=state.system_tokens))
         if initial_assistant_response:
-            history_manager.add_message({"role": "assistant", "content": initial_assistant_response})
-            print(Fore.GREEN + "\n-------------------\n")
+            state.history.add_message(make_msg("assistant", initial_assistant_response))
+            state.index.add(state.index.next_turn(), "", initial_assistant_response)
+            print(f"{TITLE}\n-------------------\n{RESET}")
         else:
-            print("Failed to generate initial story part. Exiting.")
+            log.error("Failed to generate initial story part. Exiting.")
+            discard_journal = not resumed_journal
             return
-    else:
-        # Resumed story, skip initial generation
-        pass
-
-    print(Fore.GREEN + "\n--- Story Start ---")
-    initial_assistant_response = generate_story_part_stream(openai_client, history_manager.get_history())
-    if initial_assistant_response:
-        history_manager.add_message({"role": "assistant", "content": initial_assistant_response})
-        print(Fore.GREEN + "\n-------------------\n")
-    else:
-        print("Failed to generate initial story part. Exiting.")
-        return
-
-    # Interaction loop
-    while True:
-        user_action = input("What do you do next? (Type 'save', 'quit', 'undo', 'redo'): ").strip().lower()
-        if user_action == 'save':
-            save_story(history_manager.get_history())
-            continue
-        if user_action == 'quit':
-            save_choice = input("Do you want to save the story before exiting? (y/n): ").strip().lower()
-            if save_choice == 'y':
-                save_story(history_manager.get_history())
-            print("\nExiting story.")
-            break
-        if user_action == 'undo':
-            success, msg = history_manager.undo()
-            print(msg)
-            continue
-        if user_action == 'redo':
-            success, msg = history_manager.redo()
-            print(msg)
-            continue
-
-        # Add user action to conversation and clear redo stack
-        history_manager.add_message({"role": "user", "content": user_action})
-
-        # Generate next part based on the *entire* conversation history
-        next_part = generate_story_part_stream(openai_client, history_manager.get_history())
-
-        if next_part:
-            history_manager.add_message({"role": "assistant", "content": next_part})
-            print("---------------------\n")
-        else:
-            print("Failed to generate the next part. Try again or type 'quit'.")
-            # Optional: remove the last user message if generation failed
-            if history_manager.get_history()[-1]["role"] == "user":
-                # Undo the last user message if generation failed
-                history_manager.undo()
 
+        # Summarize older turns so the prompt sent each turn stays bounded (long resumed stories start compacted)
+        state.compact(openai_client)
+
+        # Interaction loop
+        while True:
+            if prefetcher and state.history.last_message()["role"] == "assistant":
+                # Guess the next action while the user reads the last part
+                prefetcher.start(state.messages())
+
+            user_action = input("What do you do next? (Type 'save', 'quit', 'undo', 'redo'): ").strip().lower()
+            if user_action == 'save':
+                # Save snapshots in the background so the next turn doesn't wait on disk I/O
+                background_executor.submit(save_story_and_index, state.history.get_history(), EpisodicIndex(state.index.entries))
+                state.history.sync()
+                continue
+            if user_action == 'quit':
+                save_choice = input("Do you want to save the story before exiting? (y/n): ").strip().lower()
+                if save_choice == 'y':
+                    if save_story_and_index(state.history.get_history(), state.index):
+                        discard_journal = True # The story is in a snapshot now
+                    else:
+                        log.warning("Keeping the session journal %s so the story can still be recovered.", journal_path)
+                else:
+                    # Declining to save drops this session's journal, but never one the story was recovered from
+                    discard_journal = not resumed_journal
+                print("\nExiting story.")
+                break
+            if user_action == 'undo':
+                success, msg = state.history.undo()
+                if success and state.history.redo_stack[-1]["role"] == "assistant":
+                    # Don't retrieve or replay story parts the user rolled back
+                    state.index.discard(state.history.redo_stack[-1]["content"])
+                    if semantic_cache and state.history[-1]["role"] == "user":
+                        # Rewording the undone action must not bring back the rolled-back part either
+                        semantic_cache.discard(state.history[-2]["content"])
+                log.info(msg)
+                continue
+            if user_action == 'redo':
+                success, msg = state.history.redo()
+                if success and state.history[-1]["role"] == "assistant":
+                    previous_user = state.history[-2]["content"] if state.history[-2]["role"] == "user" else ""
+                    state.index.add(state.index.next_turn(), previous_user, state.history[-1]["content"])
+                log.info(msg)
+                continue
+
+            previous_part = state.history.last_message()["content"]
+            next_part = prefetcher.lookup(user_action, state.history) if prefetcher else None
+            if not next_part and prefetcher:
+                # Let fuzzy-but-semantically-close actions hit the prefetched branches too
+                for action, continuation in prefetcher.completed():
+                    semantic_cache.add(action, previous_part, continuation)
+                next_part = semantic_cache.lookup(user_action, previous_part)
+
+            # Add user action to conversation and clear redo stack
+            state.history.add_message(make_msg("user", user_action))
+
+            if next_part:
+                print_cached_response(next_part)
+            else:
+                # Generate next part from the recent turns plus the most relevant earlier ones
+                next_part = generate_story_part_stream(openai_client, state.context(), stream=STREAM_CONTINUATIONS)
+
+            if next_part:
+                state.history.add_message(make_msg("assistant", next_part))
+                state.index.add(state.index.next_turn(), user_action, next_part)
+                state.compact(openai_client)
+                print("---------------------\n")
+            else:
+                log.error("Failed to generate the next part. Try again or type 'quit'.")
+                # Optional: remove the last user message if generation failed
+                if state.history.last_message()["role"] == "user":
+                    # Undo the last user message if generation failed
+                    state.history.undo()
+
+    finally:
+        if prefetcher:
+            prefetcher.close() # Don't keep the exit waiting on speculative requests
+        state.history.close()
+        if discard_journal:
+            os.remove(journal_path)
 
 # --- Entry Point ---
 if __name__ == "__main__":
+    args = parse_args()
     print("Interactive Story Generator using Groq AI")
     print("========================================")
     print("Note: You'll need a Groq API key.")
     print("You can set the GROQ_API_KEY environment variable or enter it when prompted.")
-    run_story_app()
\ No newline at end of file
+    run_story_app(args)
\ No newline at end of file
@@ -0,0 +1,94 @@
+import functools
+from episodic_index import embed
+
+@functools.lru_cache(maxsize=1)
+def _numpy():
+    """
+    Import numpy on first use so it doesn't slow down startup, or return None if it isn't installed.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class SemanticCache:
+    """
+    Caches story continuations by the meaning of the user action, so near-duplicate
+    actions ("go north", "head north") after the same story part skip the API call.
+    """
+
+    def __init__(self, maxlen=256, threshold=0.92):
+        """
+        Keep up to `maxlen` entries in a fixed-size circular buffer.
+        """
+        self.maxlen = maxlen
+        self.threshold = threshold
+        self.embeddings = None # float32[maxlen, dim], allocated on the first add
+        self.responses = [None] * maxlen
+        self.contexts = [None] * maxlen # Hash of the story part each action followed
+        self.size = 0
+        self.next_slot = 0
+        self._last_query = (None, None) # Reuse the lookup embedding when the same action is added
+
+    def _embed(self, text):
+        np = _numpy()
+        if np is None:
+            return None
+        if self._last_query[0] == text:
+            return self._last_query[1]
+        vectors = embed([text])
+        if vectors is None:
+            return None
+        vector = np.asarray(vectors[0], dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        self._last_query = (text, vector)
+        return vector
+
+    def lookup(self, user_action, context):
+        """
+        Return the cached continuation for an action similar to `user_action`
+        that followed the same `context`, or None.
+        """
+        if self.size == 0:
+            return None
+        query = self._embed(user_action)
+        if query is None:
+            return None
+        np = _numpy()
+        sims = self.embeddings[:self.size] @ query # One BLAS call over all cached actions
+        context_key = hash(context)
+        for i in np.argsort(sims)[::-1]:
+            if sims[i] <= self.threshold:
+                return None
+            if self.contexts[i] == context_key:
+                return self.responses[i]
+        return None
+
+    def add(self, user_action, context, response):
+        """
+        Cache `response` as the continuation of `user_action` after `context`.
+        """
+        vector = self._embed(user_action)
+        if vector is None:
+            return
+        if self.embeddings is None:
+            np = _numpy()
+            self.embeddings = np.zeros((self.maxlen, vector.shape[0]), dtype=np.float32)
+        slot = self.next_slot
+        self.embeddings[slot] = vector
+        self.responses[slot] = response
+        self.contexts[slot] = hash(context)
+        self.next_slot = (slot + 1) % self.maxlen
+        self.size = min(self.size + 1, self.maxlen)
+
+    def discard(self, context):
+        """
+        Forget every continuation cached after `context` (e.g. when the part that followed it is undone).
+        """
+        context_key = hash(context)
+        for i in range(self.size):
+            if self.contexts[i] == context_key:
+                self.contexts[i] = None # Never matches a lookup again
+                self.responses[i] = None
@@ -0,0 +1,117 @@
+import difflib
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+PREDICT_PROMPT = "List 3 short, plausible actions the player might take next, one per line, without numbering or commentary."
+_LIST_MARKER_RE = re.compile(r"^\s*(?:[-*]|\d+[.)])?\s*")
+# Actions common enough in interactive fiction to prefetch without asking the model first
+COMMON_ACTIONS = ("look around", "check inventory")
+
+def normalize_action(action):
+    return " ".join(action.lower().split())
+
+
+class SpeculativePrefetcher:
+    """
+    Predicts likely next user actions and generates their continuations in the
+    background, so a matching action can be answered without waiting on the API.
+    """
+
+    def __init__(self, complete, num_candidates=3, cutoff=0.8, common_actions=COMMON_ACTIONS, max_workers=2):
+        """
+        `complete` takes a list of messages and a threading.Event, and returns the generated text,
+        or None if the event was set before it finished.
+        Continuations for `common_actions` are started right away, alongside the prediction.
+        Only `max_workers` branches run at once; queued ones are dropped outright when cancelled.
+        """
+        self.complete = complete
+        self.num_candidates = num_candidates
+        self.cutoff = cutoff
+        self.common_actions = tuple(common_actions)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.base_content = None # Content of the message the cached continuations follow
+        self.pending = {} # normalized action -> (future of its continuation, cancel event)
+        self.predict_cancelled = threading.Event()
+
+    def start(self, conversation_history):
+        """
+        Discard previous predictions and start prefetching continuations of `conversation_history`,
+        unless the current predictions already follow its last message.
+        """
+        history = list(conversation_history)
+        with self.lock:
+            if history[-1]["content"] == self.base_content:
+                return
+            self._cancel_pending()
+            self.base_content = history[-1]["content"]
+            self.predict_cancelled = threading.Event()
+            self._submit(history, self.common_actions)
+            self.executor.submit(self._predict, history, self.predict_cancelled)
+
+    def _submit(self, history, actions):
+        # Callers hold self.lock
+        for action in actions:
+            key = normalize_action(action)
+            if key not in self.pending:
+                cancelled = threading.Event()
+                future = self.executor.submit(self.complete, history + [{"role": "user", "content": action}], cancelled)
+                self.pending[key] = (future, cancelled)
+
+    def _cancel_pending(self):
+        # Callers hold self.lock. Queued branches never start; running ones stop at their next chunk
+        self.predict_cancelled.set()
+        for future, cancelled in self.pending.values():
+            future.cancel()
+            cancelled.set()
+        self.pending = {}
+
+    def _predict(self, history, cancelled):
+        try:
+            text = self.complete(history + [{"role": "user", "content": PREDICT_PROMPT}], cancelled)
+        except Exception:
+            return # Prefetching is best effort
+        actions = [_LIST_MARKER_RE.sub("", line).strip() for line in (text or "").splitlines()]
+        actions = [action for action in actions if action]
+        with self.lock:
+            if cancelled.is_set() or self.base_content != history[-1]["content"]:
+                return # A newer turn started while predicting
+            self._submit(history, actions[:self.num_candidates])
+
+    def lookup(self, user_action, conversation_history):
+        """
+        Return the prefetched continuation for an action close to `user_action`, or None.
+        Only continuations of the current last message are considered.
+        """
+        with self.lock:
+            if not conversation_history or conversation_history[-1]["content"] != self.base_content:
+                return None
+            matches = difflib.get_close_matches(normalize_action(user_action), list(self.pending), n=1, cutoff=self.cutoff)
+            if not matches:
+                return None
+            future, _ = self.pending.pop(matches[0])
+            # The user picked a branch, so the other speculative generations are no longer needed
+            self._cancel_pending()
+        try:
+            return future.result()
+        except Exception:
+            return None
+
+    def completed(self):
+        """
+        Return (action, continuation) pairs that have finished generating, e.g. to
+        offer them to a semantic cache when the exact lookup misses.
+        """
+        with self.lock:
+            done = [(action, future) for action, (future, _) in self.pending.items() if future.done() and not future.cancelled()]
+        return [(action, future.result()) for action, future in done if future.exception() is None and future.result()]
+
+    def close(self):
+        """
+        Stop all speculative work, e.g. when the session ends, without waiting for it.
+        """
+        with self.lock:
+            self._cancel_pending()
+            self.base_content = None
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,676 @@
+import os
+import sys
+import re
+import logging
+import atexit
+import functools
+import time
+import threading
+from dataclasses import dataclass, field
+from concurrent.futures import Future, ThreadPoolExecutor
+import httpx
+from colorama import init, Fore, Style # Import colorama
+from openai import OpenAI, RateLimitError as OpenAIRateLimitError, APIStatusError as OpenAIAPIStatusError, APIError as OpenAIAPIError, APITimeoutError as OpenAIAPITimeoutError
+from story_utils import dumps_json, loads_json
+from undo_redo import ConversationHistoryManager
+from episodic_index import EpisodicIndex
+from key_pool import KeyPool, parse_retry_after
+from dotenv import load_dotenv
+load_dotenv()
+# Initialize colorama; every colored message resets explicitly, so autoreset's per-write wrapping isn't needed
+init(autoreset=False)
+# Color prefixes, resolved once
+INFO = Fore.BLUE
+WARN = Fore.YELLOW
+ERR = Fore.RED
+STORY = Fore.CYAN
+TITLE = Fore.GREEN
+RESET = Style.RESET_ALL
+# Status and errors go to stderr through logging so stdout carries only the story
+log = logging.getLogger("story")
+
+
+class ColorFormatter(logging.Formatter):
+    """Colors log lines by level, matching the palette the CLI used for status messages."""
+    COLORS = {logging.INFO: INFO, logging.WARNING: WARN, logging.ERROR: ERR}
+
+    def format(self, record):
+        return f"{self.COLORS.get(record.levelno, '')}{super().format(record)}{RESET}"
+
+
+# --- Configuration ---
+# Recommended: Load API key from environment variable
+# GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
+# Several keys can be given as GROQ_API_KEYS="key1,key2" to rotate between them on rate limits
+# Fallback for simple prototype (less secure):
+GROQ_API_KEY = None # Will prompt user if not set
+OPENAI_API_KEY = None # Not used in this script, but can be set for other purposes
+OPENAI_BASE_URL = "https://openrouter.ai/api/v1" # Not used in this script, but can be set for other purposes
+
+# Models tried in order when the requested one is rate limited or returns a server error
+GROQ_FALLBACK_MODELS = ["llama-3.1-8b-instant", "gemma2-9b-it"]
+OPENROUTER_FALLBACK_MODELS = ["meta-llama/llama-3.1-8b-instruct"]
+# Passes through the whole fallback chain before giving up when every model is rate limited or erroring;
+# between passes we wait for the provider's retry-after hint, or back off exponentially without one
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+# Errors the generation code handles; the Groq SDK's classes are added when it is first loaded (see _load_groq)
+RATE_LIMIT_ERRORS = (OpenAIRateLimitError,)
+STATUS_ERRORS = (OpenAIAPIStatusError,)
+API_ERRORS = (OpenAIAPIError,)
+# Raised on request timeouts, or directly by httpx if the stream stalls mid-response
+TIMEOUT_ERRORS = (OpenAIAPITimeoutError, httpx.TimeoutException)
+
+# Model ids likely suitable for chat/instruction-following
+SUITABLE_MODEL_RE = re.compile(r"chat|instruct|llama|mixtral|gemma|mistral")
+# The filtered model list is cached on disk so warm starts skip the models API call
+MODELS_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "terminal-worlds", "groq_models.json")
+MODELS_CACHE_TTL = 24 * 3600 # Seconds; model lists change on the order of days
+# Token budget for the messages sent each turn; older turns beyond it are dropped
+MAX_CONTEXT_TOKENS = 4096
+# Optional TOML file with genre/setting/situation keys, so common invocations skip the opening prompts
+DEFAULT_PROFILE_PATH = "~/.terminal-worlds.toml"
+
+# Shared HTTP client so every request reuses pooled keep-alive connections
+# instead of paying a fresh TCP+TLS handshake per call. HTTP/2 lets concurrent
+# requests (pre-warm, fallbacks) multiplex over a single connection.
+# Idle connections are kept for 5 minutes so they survive the user's think time between turns,
+# and failed connection attempts are retried by the transport before surfacing as errors.
+shared_httpx = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_keepalive_connections=8, max_connections=100, keepalive_expiry=300.0),
+    ),
+    timeout=httpx.Timeout(connect=5.0, read=60.0, write=10.0, pool=5.0), # Bound the worst case so a stalled endpoint can't hang the CLI
+)
+atexit.register(shared_httpx.close)
+
+# Runs independent blocking work (e.g. listing models, saving) while the user is typing
+background_executor = ThreadPoolExecutor(max_workers=2)
+
+def _load_groq():
+    """
+    Imports the Groq SDK on first use, so OpenRouter-only sessions never pay for it,
+    and registers its error classes with the generation error handlers.
+    """
+    global RATE_LIMIT_ERRORS, STATUS_ERRORS, API_ERRORS, TIMEOUT_ERRORS
+    from groq import Groq, RateLimitError, APIStatusError, APIError, APITimeoutError # Import necessary Groq classes
+    if RateLimitError not in RATE_LIMIT_ERRORS:
+        RATE_LIMIT_ERRORS += (RateLimitError,)
+        STATUS_ERRORS += (APIStatusError,)
+        API_ERRORS += (APIError,)
+        TIMEOUT_ERRORS += (APITimeoutError,)
+    return Groq
+
+@functools.lru_cache(maxsize=4)
+def _make_client(api_key, base_url, kind):
+    """Returns a cached Groq/OpenAI client so repeated initialization reuses the same connection pool."""
+    # SDK retries are off: the generators retry 429s and 5xx themselves across keys, models and passes
+    # (see RETRY_ATTEMPTS), and retrying inside the SDK as well would multiply the attempts per turn
+    if kind == "groq":
+        Groq = _load_groq()
+        return Groq(api_key=api_key, http_client=shared_httpx, max_retries=0)
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=shared_httpx, max_retries=0)
+
+def _prewarm_connection(url, connections=2):
+    """Opens pooled connections to `url` in the background so the first request skips the TLS handshake."""
+    def _head():
+        try:
+            shared_httpx.head(url)
+        except httpx.HTTPError:
+            pass # Warm-up is best effort; the real request will surface any errors
+    for _ in range(connections):
+        threading.Thread(target=_head, daemon=True).start()
+
+# --- Groq Interaction ---
+def initialize_groq_client():
+    """Initializes and returns a KeyPool of Groq clients and a future for the model list (see get_groq_models)."""
+    global GROQ_API_KEY
+    api_keys = [key.strip() for key in os.environ.get("GROQ_API_KEYS", "").split(",") if key.strip()]
+    if not GROQ_API_KEY:
+        # Try getting from environment variable first
+        GROQ_API_KEY = os.environ.get("GROQ_API_KEY") or (api_keys[0] if api_keys else None)
+        if not GROQ_API_KEY:
+            GROQ_API_KEY = input(f"{WARN}Please enter your Groq API Key: {RESET}") # Yellow prompt
+            if not GROQ_API_KEY:
+                log.error("API Key is required. Exiting.")
+                sys.exit(1)
+
+    # Note: Adding try...except block here would be ideal for robust error handling with colors
+    pool = KeyPool([_make_client(api_key, None, "groq") for api_key in api_keys or [GROQ_API_KEY]])
+    cached_models = load_cached_models()
+    if cached_models is not None:
+        models_future = Future()
+        models_future.set_result(cached_models)
+    else:
+        # Fetch models in the background so it overlaps with the user typing the initial prompt
+        log.info("Fetching available models...")
+        models_future = background_executor.submit(fetch_groq_models, pool.clients[0])
+
+    log.info("Groq client initialized successfully with %s API key(s).", len(pool))
+    return pool, models_future # Return client pool and pending model list
+
+def load_cached_models():
+    """Returns the cached model list, or None if it is missing or expired."""
+    try:
+        with open(MODELS_CACHE_PATH, "rb") as f:
+            cache = loads_json(f.read())
+    except (OSError, ValueError):
+        return None
+    if cache.get("expires_at", 0) < time.time():
+        return None
+    return cache.get("models")
+
+def fetch_groq_models(client):
+    """Fetches the model list, keeps the suitable models and caches them on disk."""
+    models_response = client.models.list()
+    # print(models_response) # Keep debug print for now
+    # Filter for models likely suitable for chat/instruction-following and sort them
+    available_models = sorted(model.id for model in models_response.data if SUITABLE_MODEL_RE.search(model.id))
+    if available_models:
+        try:
+            os.makedirs(os.path.dirname(MODELS_CACHE_PATH), exist_ok=True)
+            with open(MODELS_CACHE_PATH, "wb") as f:
+                f.write(dumps_json({"models": available_models, "expires_at": time.time() + MODELS_CACHE_TTL}))
+        except OSError:
+            pass # Caching is an optimization only
+    return available_models
+
+def get_groq_models(models_future):
+    """Waits for the model list requested by initialize_groq_client and returns the suitable model ids."""
+    try:
+        available_models = models_future.result()
+    except Exception as e:
+        log.error("Failed to fetch models: %s", e)
+        return []
+    if not available_models:
+            log.warning("No suitable models found or failed to parse model list.")
+            # Let select_groq_model handle the default if list is empty
+            available_models = []
+    return available_models
+
+def initialize_openai_client():
+    """Initializes and returns the OpenAI client."""
+    global OPENAI_API_KEY, OPENAI_BASE_URL
+    if not OPENAI_API_KEY:
+        # Try getting from environment variable first
+        OPENAI_API_KEY = os.environ.get("OPENROUTER_API_KEY")
+        if not OPENAI_API_KEY:
+            OPENAI_API_KEY = input(f"{WARN}Please enter your OpenAI API Key: {RESET}") # Yellow prompt
+            if not OPENAI_API_KEY:
+                log.error("API Key is required. Exiting.")
+                sys.exit(1)
+
+    # Note: Adding try...except block here would be ideal for robust error handling with colors
+    client = _make_client(OPENAI_API_KEY, OPENAI_BASE_URL, "openai")
+    # Warm up the connection while the user types the initial prompt
+    _prewarm_connection(OPENAI_BASE_URL + "/models")
+    log.info("OpenAI client initialized successfully.")
+    return client
+
+def select_groq_model(models):
+    """Uses 'pick' to let the user select a model."""
+    from pick import pick # Deferred, only needed when choosing a model
+    if not models:
+        log.warning("Could not fetch models or no suitable models found. Using default: llama3-8b-8192")
+        return "llama3-8b-8192" # Fallback default
+
+    title = f"{TITLE}Please choose a Groq model (navigate with arrows, select with Enter):{RESET}" # Green title
+    options = models
+    # Try to find a sensible default like llama3-8b, keeping index 0 if it isn't found
+    index_by_id = {model_id: i for i, model_id in enumerate(options)}
+    default_index = index_by_id.get("llama3-8b-8192", 0)
+
+    try:
+        selected_model, index = pick(options, title, indicator='=>', default_index=default_index)
+        log.info("Using model: %s", selected_model)
+        return selected_model
+    except Exception as e: # Catch potential errors during pick usage (e.g., user Ctrl+C)
+        # Using f-string with color codes requires careful concatenation or multiple prints
+        log.error("\nError during model selection or selection cancelled: %s. Using default: llama3-8b-8192", e)
+        return "llama3-8b-8192" # Fallback default
+
+
+def fallback_chain(model, fallback_models):
+    """Returns the requested model followed by the fallback models, without duplicates."""
+    return [model] + [fallback for fallback in fallback_models if fallback != model]
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Seconds to wait before retry `attempt` (0-based): the provider's hint if given, else exponential backoff."""
+    delay = retry_after if retry_after is not None else RETRY_BASE_DELAY * 2 ** attempt
+    return min(delay, RETRY_MAX_DELAY)
+
+
+def print_stream(completion, flush_every=16):
+    """
+    Prints streamed chunks in cyan and returns the full response text.
+    Output is buffered and flushed every `flush_every` chunks or on a newline
+    instead of flushing stdout once per token.
+    """
+    response_parts = []
+    buffer = []
+    # Bind hot-loop lookups once instead of resolving them per chunk
+    write = sys.stdout.write
+    flush = sys.stdout.flush
+    append_part = response_parts.append
+    append_buffer = buffer.append
+    write(STORY)
+    for count, chunk in enumerate(completion, 1):
+        delta = chunk.choices[0].delta.content
+        if delta is None: # Role and finish chunks carry no content
+            continue
+        append_part(delta)
+        append_buffer(delta)
+        if count % flush_every == 0 or "\n" in delta:
+            write("".join(buffer))
+            flush()
+            buffer.clear()
+    write("".join(buffer) + RESET)
+    flush()
+    return "".join(response_parts)
+
+
+def generate_story_part(client, conversation_history, model="microsoft/wizardlm-2-8x22b:nitro", fallback_models=GROQ_FALLBACK_MODELS, max_context_tokens=MAX_CONTEXT_TOKENS): #default model for openrouter
+    """
+    Generates the next story part using Groq, rotating across API keys when one is rate limited
+    and falling back to the next model in the chain on rate limits or server errors.
+    Only the system prompt and the most recent turns within `max_context_tokens` are sent.
+    """
+    conversation_history = window_history(conversation_history, max_context_tokens)
+    pool = client if isinstance(client, KeyPool) else KeyPool([client])
+    rate_limited = False # Otherwise every model failed with server errors
+    for attempt in range(RETRY_ATTEMPTS):
+        retry_soon = False # Set by failures that may clear up after a backoff, unlike a long rate limit
+        for model_name in fallback_chain(model, fallback_models):
+            for _ in range(len(pool)):
+                client = pool.acquire(model_name)
+                if client is None:
+                    rate_limited = True # Every key is still blocked for this model
+                    break
+                try:
+                    completion = client.chat.completions.create(
+                        messages=conversation_history,
+                        model=model_name,
+                        temperature=0.8, # Adjust creativity
+                        max_tokens=512, # Limit response length
+                        top_p=1,
+                        stop=None, # Can add stop sequences if needed
+                        stream=True,
+                    )
+                except RATE_LIMIT_ERRORS as e:
+                    rate_limited = True
+                    pool.penalize(client, parse_retry_after(e), model_name)
+                    continue
+                except STATUS_ERRORS as e:
+                    if e.status_code >= 500:
+                        retry_soon = True
+                        break # Server error, move on to the next model
+                    log.error("Groq API Error during generation: %s", e)
+                    return None
+                except TIMEOUT_ERRORS:
+                    log.error("The request timed out. Please try again.")
+                    return None
+                except API_ERRORS as e:
+                    log.error("Groq API Error during generation: %s", e)
+                    return None
+                except Exception as e:
+                    log.error("An unexpected error occurred during generation: %s", e)
+                    return None
+
+                if model_name != model:
+                    log.warning("Using fallback model: %s", model_name)
+                try:
+                    print("\n--- Story Continues ---")
+                    # Print deltas as they arrive so the first tokens show up right away
+                    response_content = print_stream(completion)
+                except TIMEOUT_ERRORS:
+                    log.error("\nThe response stream timed out. Please try again.")
+                    return None
+                except Exception as e:
+                    log.error("An unexpected error occurred during generation: %s", e)
+                    return None
+                # Rough token estimate (~4 characters per token) for the per-key TPM counters
+                pool.record(client, (sum(len(msg["content"]) for msg in conversation_history) + len(response_content)) // 4)
+                return response_content
+        blocked_for = pool.wait_time()
+        if not retry_soon and blocked_for > RETRY_MAX_DELAY:
+            break # No key frees up within the longest wait we allow, so retrying would send nothing
+        if attempt < RETRY_ATTEMPTS - 1:
+            # Wait out the shortest rate limit; server errors leave no hint, so back off instead
+            wait = backoff_delay(attempt, blocked_for or None)
+            log.warning("All API keys and models are unavailable, retrying in %.1fs...", wait)
+            time.sleep(wait)
+
+    if rate_limited:
+        log.error("Rate limit reached. Please wait and try again.")
+    else:
+        log.error("The models are unavailable right now (server errors). Please try again later.")
+    return None
+
+
+def _cache_breakpoint(msg):
+    return {
+        "role": msg["role"],
+        "content": [{"type": "text", "text": msg["content"], "cache_control": {"type": "ephemeral"}}],
+    }
+
+
+def with_prompt_cache(conversation_history):
+    """
+    Returns the messages with cache_control breakpoints on the system prompt and the last
+    assistant turn, so the provider can serve the rolling prefix from its prompt cache.
+    The stored history is left untouched so the prefix stays byte-identical across turns.
+    """
+    messages = list(conversation_history)
+    if messages and messages[0]["role"] == "system":
+        messages[0] = _cache_breakpoint(messages[0])
+    for i in range(len(messages) - 1, 0, -1):
+        if messages[i]["role"] == "assistant":
+            messages[i] = _cache_breakpoint(messages[i])
+            break
+    return messages
+
+
+def print_cached_response(response):
+    """Prints a prefetched or semantically cached story part the same way a generated one is shown."""
+    print("\n--- Story Continues ---")
+    print(f"{STORY}{response}{RESET}")
+
+
+def complete_story_part(client, conversation_history, model="mistralai/mistral-nemo:nitro", cancelled=None):
+    """
+    Generates a story part without printing it (used for speculative prefetch).
+    The response is streamed so it can be abandoned once the `cancelled` event is set; returns None then.
+    """
+    if cancelled is not None and cancelled.is_set():
+        return None
+    completion = client.chat.completions.create(
+        messages=with_prompt_cache(conversation_history),
+        model=model,
+        temperature=0.9, # Adjust creativity
+        max_tokens=256, # Limit response length
+        top_p=1,
+        stream=True,
+    )
+    parts = []
+    for chunk in completion:
+        if cancelled is not None and cancelled.is_set():
+            completion.close() # Dropping the connection stops the provider generating (and billing) the rest
+            return None
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+    return "".join(parts)
+
+
+def generate_story_part_stream(client, conversation_history, model="mistralai/mistral-nemo:nitro", fallback_models=OPENROUTER_FALLBACK_MODELS, stream=True):
+    """
+    Generates the next story part using OPENAI, falling back to the next model on rate limits or server errors.
+    With stream=False the whole part is fetched in one response, which avoids per-chunk overhead.
+    """
+    completion = None
+    rate_limited = False # Otherwise every model failed with server errors
+    for attempt in range(RETRY_ATTEMPTS):
+        retry_after = None # Shortest retry-after hint seen in this pass
+        retry_soon = False # Set by server errors and by rate limits without a hint
+        for model_name in fallback_chain(model, fallback_models):
+            try:
+                completion = client.chat.completions.create(
+                    messages=with_prompt_cache(conversation_history), # Lets OpenRouter serve the prefix from its prompt cache
+                    model=model_name,
+                    temperature=0.9, # Adjust creativity
+                    max_tokens=256, # Limit response length
+                    top_p=1,
+                    stop=None, # Can add stop sequences if needed
+                    stream=stream,
+                )
+                break
+            except RATE_LIMIT_ERRORS as e:
+                log.warning("Rate limit reached for %s, trying the next model.", model_name)
+                rate_limited = True
+                hint = parse_retry_after(e, default=None)
+                if hint is None:
+                    retry_soon = True
+                else:
+                    retry_after = hint if retry_after is None else min(retry_after, hint)
+            except STATUS_ERRORS as e:
+                if e.status_code < 500:
+                    log.error("API Error during generation: %s", e)
+                    return None
+                log.warning("%s is unavailable, trying the next model.", model_name)
+                retry_soon = True
+            except TIMEOUT_ERRORS:
+                log.error("The request timed out. Please try again.")
+                return None
+            except API_ERRORS as e:
+                log.error("API Error during generation: %s", e)
+                return None
+            except Exception as e:
+                log.error("An unexpected error occurred during generation: %s", e)
+                return None
+        if completion is not None:
+            break
+        if not retry_soon and retry_after is not None and retry_after > RETRY_MAX_DELAY:
+            break # The provider says every model stays limited longer than we're willing to wait
+        if attempt < RETRY_ATTEMPTS - 1:
+            wait = backoff_delay(attempt, retry_after)
+            log.warning("All models are unavailable, retrying in %.1fs...", wait)
+            time.sleep(wait)
+    if completion is None:
+        if rate_limited:
+            log.error("Rate limit reached. Please wait and try again.")
+        else:
+            log.error("The models are unavailable right now (server errors). Please try again later.")
+        return None
+
+    if model_name != model:
+        log.warning("Using fallback model: %s", model_name)
+    try:
+        print("\n--- Story Continues ---")
+        if stream:
+            response_content = print_stream(completion) # Print in cyan as it streams
+        else:
+            response_content = completion.choices[0].message.content
+            print(f"{STORY}{response_content}{RESET}")
+    except TIMEOUT_ERRORS:
+        log.error("\nThe response stream timed out. Please try again.")
+        return None
+    except Exception as e:
+        log.error("An unexpected error occurred during generation: %s", e)
+        return None
+    return response_content
+
+# --- Story Logic ---
+@dataclass
+class StoryState:
+    """Per-story state passed through the interaction loop."""
+    system_prompt: str # Formatted once and never rewritten, so the provider's prefix cache keeps hitting
+    history: ConversationHistoryManager
+    index: EpisodicIndex
+    system_tokens: int = field(init=False) # Counted once per session instead of on every trim
+    summary: str = None # Running summary sent in place of history[1:summarized]; the stored history keeps the full text
+    summarized: int = 1
+    summary_end: dict = None # Last message the summary covers, to notice when undo replaced it
+    compact_failed_at: int = 0 # History length when summarizing last failed; not retried until the history grows
+
+    def __post_init__(self):
+        self.system_tokens = count_tokens(self.system_prompt)
+
+    def messages(self):
+        """Returns the current history, with summarized turns replaced by the summary."""
+        self._drop_stale_summary()
+        history = self.history.get_history()
+        if self.summary:
+            return [history[0], make_msg("system", "Story so far: " + self.summary)] + history[self.summarized:]
+        return history
+
+    def _drop_stale_summary(self):
+        if self.summary and (len(self.history) < self.summarized or self.history[self.summarized - 1] is not self.summary_end):
+            # Undo went back past the summarized turns, so the summary no longer matches the history
+            self.summary, self.summarized, self.summary_end = None, 1, None
+
+    def compact(self, client, keep_last=6, threshold=20):
+        """
+        Folds older turns into the running summary once more than `threshold` messages haven't been summarized,
+        keeping the last `keep_last` verbatim, so the prompt sent each turn stays bounded.
+        """
+        self._drop_stale_summary()
+        if len(self.history) - self.summarized <= threshold or len(self.history) <= self.compact_failed_at:
+            return
+        turns = self.history.get_history()[self.summarized:]
+        folded, self.summary = compact_history(client, turns, self.summary, keep_last=keep_last, threshold=threshold)
+        self.summarized += folded
+        if folded:
+            self.summary_end = turns[folded - 1]
+        else:
+            self.compact_failed_at = len(self.history)
+
+    def context(self):
+        """Returns the messages to send for the next turn: relevant earlier turns plus the recent ones, within the token budget."""
+        return window_history(self.index.build_context(self.messages()), system_tokens=self.system_tokens)
+
+
+def make_msg(role, content):
+    """Builds a chat message dict."""
+    return {"role": role, "content": content}
+
+
+def load_profile(path, explicit=False):
+    """
+    Reads story parameters (genre, setting, situation) from a TOML profile, or {} if it can't be read.
+    A missing file is only reported for a profile the user asked for explicitly.
+    """
+    try:
+        import tomllib # Deferred, only needed when a profile is used; Python 3.11+
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            if explicit:
+                log.warning("Could not read profile %s: TOML support needs Python 3.11+ or the tomli package", path)
+            return {}
+    try:
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    except FileNotFoundError:
+        if explicit:
+            log.warning("Profile %s does not exist", path)
+        return {}
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        log.warning("Could not read profile %s: %s", path, e)
+        return {}
+
+
+def get_initial_prompt(args=None):
+    """
+    Gets initial story parameters from command line flags, then the profile, prompting only for what's missing.
+    """
+    genre = getattr(args, "genre", None)
+    setting = getattr(args, "setting", None)
+    situation = getattr(args, "situation", None)
+    if not (genre and setting and situation):
+        explicit_profile = getattr(args, "profile", None)
+        profile = load_profile(os.path.expanduser(explicit_profile or DEFAULT_PROFILE_PATH), explicit=bool(explicit_profile))
+        genre = genre or profile.get("genre")
+        setting = setting or profile.get("setting")
+        situation = situation or profile.get("situation")
+    if not (genre and setting and situation):
+        print("\nLet's start a story!")
+    genre = genre or input("Genre (e.g., fantasy, sci-fi): ")
+    setting = setting or input("Setting (e.g., a dark forest, a spaceship): ")
+    situation = situation or input("Starting situation: ")
+    base_prompt = os.getenv("SYSTEM_PROMPT", "")
+    # Construct a system prompt once; it must never be rewritten afterwards or the provider's prefix cache misses
+    system_prompt = f"{base_prompt} The story is in the {genre} genre, set in {setting}. The story begins with: {situation}."
+
+    # Return as the first message(s) in the conversation history
+    return [make_msg("system", system_prompt)]
+
+
+def compact_history(client, turns, summary=None, keep_last=6, summary_tokens=300, threshold=20, model="mistralai/mistral-nemo:nitro"):
+    """
+    Folds all but the last `keep_last` of `turns` (the messages not yet summarized) into the running `summary`
+    once there are more than `threshold` of them.
+    Returns the number of turns folded in and the updated summary, or (0, summary) if nothing changed.
+    """
+    if len(turns) <= threshold:
+        return 0, summary
+
+    older = turns[:-keep_last]
+    transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in older)
+    if summary:
+        transcript = f"Story so far: {summary}\n{transcript}"
+    try:
+        completion = client.chat.completions.create(
+            messages=[
+                {"role": "system", "content": "Summarize the prior events of this interactive story concisely, keeping names, places and open plot threads."},
+                {"role": "user", "content": transcript},
+            ],
+            model=model,
+            temperature=0.3, # Keep the summary factual
+            max_tokens=summary_tokens,
+        )
+        new_summary = completion.choices[0].message.content
+    except Exception as e:
+        log.warning("Could not summarize the story so far, sending full history: %s", e)
+        return 0, summary
+    if not new_summary:
+        return 0, summary
+
+    return len(older), new_summary
+
+
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    """Loads the tiktoken encoding once, or returns None if tiktoken isn't installed or the encoding can't be loaded."""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base") # Downloads the BPE file on first use
+    except Exception as e:
+        log.warning("Estimating token counts, could not load the tiktoken encoding: %s", e)
+        return None
+
+
+@functools.lru_cache(maxsize=1024)
+def count_tokens(text):
+    """
+    Counts tokens with tiktoken, or estimates ~4 characters per token if it isn't installed.
+    Memoized per message text, so only the newest message is tokenized on each turn.
+    """
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text))
+
+
+def window_history(conversation_history, max_context_tokens=MAX_CONTEXT_TOKENS, system_tokens=None):
+    """
+    Keeps the leading system messages plus as many of the most recent messages as fit in
+    `max_context_tokens`, dropping the oldest turns first. The newest message is always kept.
+    `system_tokens` is the precomputed size of the first system message, if known.
+    """
+    leading = []
+    for msg in conversation_history:
+        if msg["role"] != "system":
+            break
+        leading.append(msg)
+    rest = conversation_history[len(leading):]
+    budget = max_context_tokens - sum(count_tokens(msg["content"]) for msg in leading[1:])
+    if leading:
+        budget -= count_tokens(leading[0]["content"]) if system_tokens is None else system_tokens
+
+    kept = []
+    for msg in reversed(rest):
+        budget -= count_tokens(msg["content"])
+        if budget < 0 and kept:
+            break
+        kept.append(msg)
+    if len(kept) == len(rest):
+        return conversation_history
+    return leading + kept[::-1]
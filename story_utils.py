@@ -1,47 +1,87 @@
 import json
+import logging
+import re
 from datetime import datetime
+try:
+    import orjson # Much faster than the stdlib json serializer
+except ImportError:
+    orjson = None
+try:
+    import zstandard # Chat histories are highly redundant and compress 5-10x
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger("story")
+_NON_WORD_RE = re.compile(r'\W+')
+ZSTD_LEVEL = 3
+
+def dumps_json(obj, indent=True):
+    """
+    Serialize `obj` to UTF-8 JSON bytes, using orjson when available.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
+def loads_json(data):
+    """
+    Parse JSON bytes, using orjson when available.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 def save_story(conversation_history, filename=None):
     """
-    Save the conversation history to a JSON file.
-    If filename is not provided, generate one with a timestamp.
+    Save the conversation history to a JSON file, zstd-compressed if the filename ends in .zst.
+    If filename is not provided, generate one with a timestamp (compressed when zstandard is installed).
+    Returns the filename on success, None otherwise.
     """
     if not filename:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 
         # Extract snippet from first system or assistant message
         snippet = ""
-        for msg in conversation_history:
-            if msg.get("role") in ("system", "assistant"):
-                content = msg.get("content", "")
-                words = content.strip().split()
-                snippet = "_".join(words[:5]).lower()
-                # Remove punctuation and limit length
-                import re
-                snippet = re.sub(r'\W+', '_', snippet)
-                snippet = snippet[:20]
-                break
+        first = next((msg for msg in conversation_history if msg.get("role") in ("system", "assistant")), None)
+        if first is not None:
+            words = first.get("content", "").strip().split()
+            snippet = "_".join(words[:5]).lower()
+            # Remove punctuation and limit length
+            snippet = _NON_WORD_RE.sub('_', snippet)[:20]
 
         filename = f"story_{timestamp}"
         if snippet:
             filename += f"_{snippet}"
-        filename += ".json"
+        filename += ".json.zst" if zstandard is not None else ".json"
     try:
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump(conversation_history, f, ensure_ascii=False, indent=2)
-        print(f"Story saved to {filename}")
+        if filename.endswith(".zst"):
+            if zstandard is None:
+                raise ImportError("zstandard is required to save compressed stories")
+            data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(dumps_json(conversation_history, indent=False))
+        else:
+            data = dumps_json(conversation_history)
+        with open(filename, "wb") as f:
+            f.write(data)
+        log.info("Story saved to %s", filename)
+        return filename
     except Exception as e:
-        print(f"Error saving story: {e}")
+        log.error("Error saving story: %s", e)
+        return None
 
 def load_story(filename):
     """
-    Load a conversation history from a JSON file.
+    Load a conversation history from a JSON file, decompressing it first if it ends in .zst.
     """
     try:
-        with open(filename, "r", encoding="utf-8") as f:
-            conversation_history = json.load(f)
-        print(f"Story loaded from {filename}")
+        with open(filename, "rb") as f:
+            data = f.read()
+        if filename.endswith(".zst"):
+            if zstandard is None:
+                raise ImportError("zstandard is required to load compressed stories")
+            data = zstandard.ZstdDecompressor().decompress(data)
+        conversation_history = loads_json(data)
+        log.info("Story loaded from %s", filename)
         return conversation_history
     except Exception as e:
-        print(f"Error loading story: {e}")
+        log.error("Error loading story: %s", e)
         return None
\ No newline at end of file
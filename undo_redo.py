@@ -1,14 +1,29 @@
+import os
+from collections import deque
+from story_utils import dumps_json, loads_json
+
 class ConversationHistoryManager:
     """
     Manages conversation history with undo/redo functionality for an interactive story generator.
     """
 
-    def __init__(self, initial_history):
+    def __init__(self, initial_history, log_path=None):
         """
         Initialize with the current conversation history (list of message dicts).
+        If `log_path` is given, every change is appended to that JSONL journal,
+        so persisting a turn costs one line instead of rewriting the whole story.
         """
-        self.conversation_history = list(initial_history)  # Make a copy to avoid side effects
-        self.redo_stack = []
+        self.conversation_history = deque(initial_history)  # Make a copy to avoid side effects
+        self.redo_stack = deque()
+        self.log = None
+        if log_path:
+            self.log = open(log_path, "ab")
+            self._append({"op": "reset", "messages": list(self.conversation_history)})
+
+    def _append(self, entry):
+        if self.log is not None:
+            self.log.write(dumps_json(entry, indent=False) + b"\n")
+            self.log.flush() # Hand the line to the OS; fsync only happens in sync()
 
     def can_undo(self):
         # Prevent undoing past the initial system prompt
@@ -25,6 +40,7 @@ class ConversationHistoryManager:
         if self.can_undo():
             last_msg = self.conversation_history.pop()
             self.redo_stack.append(last_msg)
+            self._append({"op": "undo"})
             return True, "Last action undone."
         else:
             return False, "Nothing to undo."
@@ -37,6 +53,7 @@ class ConversationHistoryManager:
         if self.can_redo():
             msg = self.redo_stack.pop()
             self.conversation_history.append(msg)
+            self._append({"op": "redo"})
             return True, "Last undone action redone."
         else:
             return False, "Nothing to redo."
@@ -48,16 +65,69 @@ class ConversationHistoryManager:
         """
         self.conversation_history.append(msg)
         self.redo_stack.clear()
+        self._append({"op": "add", "message": msg})
 
     def get_history(self):
         """
-        Get the current conversation history (for saving, generating, etc.).
+        Get a list snapshot of the current conversation history (for saving, generating, etc.).
+        """
+        return list(self.conversation_history)
+
+    def last_message(self):
+        """
+        Get the most recent message without copying the history.
+        """
+        return self.conversation_history[-1]
+
+    def __len__(self):
+        return len(self.conversation_history)
+
+    def __getitem__(self, index):
+        """
+        Get one message without copying the history (O(1) near either end).
         """
-        return self.conversation_history
+        return self.conversation_history[index]
 
     def reset(self, new_history):
         """
         Reset the conversation history and clear the redo stack.
         """
-        self.conversation_history = list(new_history)
-        self.redo_stack.clear()
\ No newline at end of file
+        self.conversation_history = deque(new_history)
+        self.redo_stack.clear()
+        self._append({"op": "reset", "messages": list(self.conversation_history)})
+
+    def sync(self):
+        """
+        Force the journal to disk (e.g. when the user saves).
+        """
+        if self.log is not None:
+            self.log.flush()
+            os.fsync(self.log.fileno())
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    @classmethod
+    def replay(cls, log_path):
+        """
+        Rebuild a manager from a journal written with `log_path`.
+        A partially written last line (e.g. after a crash) is ignored.
+        """
+        manager = cls([])
+        with open(log_path, "rb") as f:
+            for line in f:
+                try:
+                    entry = loads_json(line)
+                except ValueError:
+                    break
+                if entry["op"] == "add":
+                    manager.add_message(entry["message"])
+                elif entry["op"] == "undo":
+                    manager.undo()
+                elif entry["op"] == "redo":
+                    manager.redo()
+                elif entry["op"] == "reset":
+                    manager.reset(entry["messages"])
+        return manager
\ No newline at end of file